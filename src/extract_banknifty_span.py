@@ -21,10 +21,14 @@ What it does:
 """
 
 import sys
+import contextlib
 import zipfile
 import xml.etree.ElementTree as ET
 import csv
 import os
+import hashlib
+import json
+from collections import namedtuple
 
 # ===== USER SETTINGS =====
 # Change this to your file path, or call script with the file path as first arg.
@@ -38,9 +42,20 @@ EXPOSURE_RATES = [0.02, 0.02265]   # 2.00% and 2.265% (example)
 # Fallback lot size if not present in file (BankNifty historical/common): adjust as needed.
 FALLBACK_LOT = 35
 
+# <phy> tags that may carry the lot size, in order of preference. <sc> is not one
+# of them: it is the SPAN contract scale factor (1.0 for index underlyings).
+LOT_TAGS = ("m", "mult", "mktLot", "lotSize", "lot", "l")
+
+# Parsed SPN data is cached here (keyed by input path, mtime, size and SYMBOL) so
+# re-runs with other EXPOSURE_RATES skip the XML parse. Set to None to disable.
+CACHE_DIR = ".spn_cache"
+# Bump whenever the cached (series, phy) layout or its meaning changes.
+CACHE_VERSION = 4
+
 # ========== Helper functions ==========
-def read_spn_from_path(path):
-    """Return XML content string from either .zip (containing .spn) or .spn file directly."""
+@contextlib.contextmanager
+def open_spn_from_path(path):
+    """Yield a binary stream of the SPN XML from either .zip (containing .spn) or .spn file directly."""
     if path.lower().endswith(".zip"):
         if not os.path.exists(path):
             raise FileNotFoundError(f"ZIP not found: {path}")
@@ -49,27 +64,198 @@ def read_spn_from_path(path):
             spn_name = next((n for n in z.namelist() if n.lower().endswith(".spn")), None)
             if spn_name is None:
                 raise FileNotFoundError("No .spn file found inside ZIP")
-            raw = z.read(spn_name)
-            return raw.decode("latin-1", errors="ignore")
+            # decompressed lazily as the parser reads, never held in memory whole
+            with z.open(spn_name) as f:
+                yield f
+                # the parser may stop early; decompress the rest (without
+                # parsing it) so ZipExtFile verifies the member's CRC at EOF
+                # and a corrupt archive raises BadZipFile
+                while f.read(1 << 20):
+                    pass
     elif path.lower().endswith(".spn"):
         with open(path, "rb") as f:
-            raw = f.read()
-            return raw.decode("latin-1", errors="ignore")
+            yield f
     else:
         # try both attempts
-        if os.path.exists(path + ".zip"):
-            return read_spn_from_path(path + ".zip")
-        if os.path.exists(path + ".spn"):
-            return read_spn_from_path(path + ".spn")
+        for candidate in (path + ".zip", path + ".spn"):
+            if os.path.exists(candidate):
+                with open_spn_from_path(candidate) as f:
+                    yield f
+                return
         raise FileNotFoundError(f"Input file not found or not .zip/.spn: {path}")
 
-def get_parent(root_elem, child_elem):
-    """Bruteforce parent lookup for xml.etree (no parent pointer)."""
-    for p in root_elem.iter():
-        for c in p:
-            if c is child_elem:
-                return p
-    return None
+# One option and one expiry as read from the SPN, all fields raw text. Named
+# tuples keep the per-option footprint of a plain tuple (no per-row dict).
+SpanOption = namedtuple("SpanOption", "typ strike premium delta raw_a_vals")
+SpanSeries = namedtuple("SpanSeries", "expiry_raw opts")
+
+class SpanTarget:
+    """XMLParser target that picks SYMBOL's options and underlying out of an SPN stream.
+
+    No Element objects are built: a tag stack plus a little state is enough to
+    follow pfCode, series/pe, opt/{o,k,p,d}, opt/ra/a and the <phy> fields.
+    close() returns (series, phy) where series is a list of SpanSeries, each
+    holding its SpanOption records, and phy maps <phy> child tags to their text.
+    """
+
+    # opt children we keep, mapped to their slot in the emitted tuple
+    _OPT_FIELDS = {"o": 0, "k": 1, "p": 2, "d": 3}
+    # SPAN risk arrays have 16 scenarios; extra <a> in malformed files are ignored
+    _RA_SIZE = 16
+    # lower-cased pf block tags for options and underlying
+    _OOP_TAGS = frozenset(("ooppf",))
+    _PHY_TAGS = frozenset(("phypf",))
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.found_clearing = False
+        self.done = False
+        self._series = None        # first SYMBOL oopPf
+        self._phy = None           # first SYMBOL phyPf
+        self._series_guess = None  # sometimes tags vary; guessed from content
+        self._phy_guess = None
+        self._path = []
+        self._in_clearing = False
+        self._text = None
+        # state of the SYMBOL pf block being read (_block is its depth, 0 if none)
+        self._block = 0
+        self._block_tag = None
+        self._block_series = None
+        self._block_phy = None
+        self._phy_open = False
+        self._pe = None
+        self._opts = None
+        self._opt = None
+        self._ra = None
+        self._ra_open = False
+
+    def start(self, tag, attrib):
+        # work on local names so namespaced files ("{uri}tag") match too;
+        # end() takes them back off the path
+        if tag[0] == "{":
+            tag = tag.rpartition("}")[2]
+        path = self._path
+        path.append(tag)
+        depth = len(path)
+        # only leaves are captured; a child start means the parent was not one
+        self._text = None
+        if self._block:
+            rel = depth - self._block
+            if rel == 1:
+                if tag == "series":
+                    self._pe = None
+                    self._opts = []
+                elif tag == "phy" and self._block_phy is None:
+                    self._block_phy = {}
+                    self._phy_open = True
+            elif rel == 2:
+                parent = path[-2]
+                if parent == "series":
+                    if tag == "opt":
+                        self._opt = [None, None, None, None]
+                        self._ra = None
+                    elif tag == "pe" and self._pe is None:
+                        self._text = []
+                elif parent == "phy" and self._phy_open:
+                    self._text = []
+            elif rel == 3 and self._opt is not None:
+                if tag == "ra":
+                    if self._ra is None:
+                        self._ra = []
+                        self._ra_open = True
+                elif tag in self._OPT_FIELDS:
+                    self._text = []
+            elif (rel == 4 and self._ra_open and tag == "a"
+                    and len(self._ra) < self._RA_SIZE):
+                self._text = []
+        elif self._in_clearing:
+            if tag == "pfCode":
+                self._text = []
+        elif (depth == 3 and tag == "clearingOrg" and path[1] == "pointInTime"
+                and not self.found_clearing):
+            # locate pointInTime -> clearingOrg
+            self._in_clearing = self.found_clearing = True
+
+    def data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def end(self, tag):
+        path = self._path
+        depth = len(path)
+        tag = path.pop()
+        text = None
+        if self._text is not None:
+            text = "".join(self._text)
+            self._text = None
+
+        if self._block:
+            rel = depth - self._block
+            if rel == 4:
+                if text is not None:
+                    self._ra.append(text)
+            elif rel == 3:
+                if text is not None:
+                    slot = self._OPT_FIELDS[tag]
+                    if self._opt[slot] is None:
+                        self._opt[slot] = text
+                elif tag == "ra" and self._ra_open:
+                    self._ra_open = False
+            elif rel == 2:
+                if text is not None:
+                    if path[-1] == "series":
+                        self._pe = text
+                    else:
+                        self._block_phy.setdefault(tag, text)
+                elif tag == "opt" and self._opt is not None:
+                    # skip if no RA present
+                    if self._ra is not None:
+                        opt = self._opt
+                        self._opts.append(SpanOption(opt[0], opt[1], opt[2], opt[3], self._ra))
+                    self._opt = None
+            elif rel == 1:
+                if tag == "series":
+                    self._block_series.append(SpanSeries(self._pe, self._opts))
+                elif tag == "phy":
+                    self._phy_open = False
+            elif rel == 0:
+                self._end_block()
+        elif self._in_clearing:
+            if text is not None:
+                # a pfCode equal to SYMBOL makes its parent the block to read
+                if text.strip().upper() == self.symbol:
+                    self._block = depth - 1
+                    self._block_tag = path[-1]
+                    self._block_series = []
+                    self._block_phy = None
+            elif depth == 3:
+                self._in_clearing = False
+                self.done = True
+
+    def _end_block(self):
+        kind = self._block_tag.lower()
+        if kind in self._OOP_TAGS:
+            if self._series is None:
+                self._series = self._block_series
+        elif kind in self._PHY_TAGS:
+            if self._phy is None:
+                self._phy = self._block_phy if self._block_phy is not None else {}
+        elif self._block_series:
+            if self._series_guess is None:
+                self._series_guess = self._block_series
+        elif self._block_phy is not None:
+            if self._phy_guess is None:
+                self._phy_guess = self._block_phy
+        self._block = 0
+        # first tagged oopPf and phyPf both seen: nothing later can change the
+        # result, so the caller can stop parsing the rest of the file
+        if self._series is not None and self._phy is not None:
+            self.done = True
+
+    def close(self):
+        series = self._series if self._series is not None else self._series_guess
+        phy = self._phy if self._phy is not None else self._phy_guess
+        return series, phy
 
 def safe_float(x):
     try:
@@ -77,177 +263,214 @@ def safe_float(x):
     except:
         return None
 
+def float_column(values):
+    """Convert a whole column of texts to floats; unparseable entries become None."""
+    try:
+        # one C-level pass when the column is clean, which it normally is
+        return list(map(float, values))
+    except (TypeError, ValueError):
+        return [safe_float(x) for x in values]
+
+def parse_ra_values(raw_a_vals):
+    """Convert the raw <a> texts of a risk array to floats, dropping unparseable ones."""
+    try:
+        # fast path: one C-level map over the whole array (float() ignores
+        # surrounding whitespace; remove thousand separators if any)
+        return list(map(float, [v.replace(",", "") for v in raw_a_vals]))
+    except ValueError:
+        pass
+    a_vals = []
+    for v in raw_a_vals:
+        vclean = v.strip().replace(",", "")
+        try:
+            a_vals.append(float(vclean))
+        except:
+            # try to strip non-numeric
+            filtered = "".join(ch for ch in vclean if ch in "0123456789-+.eE")
+            try:
+                a_vals.append(float(filtered))
+            except:
+                pass
+    return a_vals
+
+def parse_spn(path, symbol):
+    """Stream the SPN XML at path through SpanTarget and return its (series, phy)."""
+    # the zip member is decompressed chunk by chunk as it is fed; nothing but
+    # symbol's option and underlying fields is ever materialised, and parsing
+    # stops as soon as the target has what it needs
+    target = SpanTarget(symbol)
+    # NSE files are Latin-1; let expat decode the raw bytes directly
+    parser = ET.XMLParser(target=target, encoding="latin-1")
+    with open_spn_from_path(path) as f:
+        while not target.done:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                # end of input before the target was done: tell expat, so a
+                # truncated or malformed file raises ParseError (close() also
+                # returns target.close())
+                result = parser.close()
+                break
+            parser.feed(chunk)
+        else:
+            # stopped early on purpose; the rest of the document is not parsed
+            result = target.close()
+    if not target.found_clearing:
+        raise ValueError("pointInTime/clearingOrg node not found in SPN XML")
+    return result
+
+def parse_spn_cached(path, symbol):
+    """parse_spn(), memoized as JSON in CACHE_DIR keyed by the input's path, mtime and size."""
+    if not CACHE_DIR:
+        return parse_spn(path, symbol)
+    try:
+        st = os.stat(path)
+    except OSError:
+        # bare name without .zip/.spn; let open_spn_from_path resolve it
+        return parse_spn(path, symbol)
+    key_src = f"v{CACHE_VERSION}:{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size}:{symbol}"
+    key = hashlib.blake2b(key_src.encode(), digest_size=8).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        # JSON, not pickle: loading a cache file must never run code
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        series = cached["series"]
+        if series is not None:
+            series = [SpanSeries(expiry_raw, [SpanOption(*opt) for opt in opts])
+                      for expiry_raw, opts in series]
+        result = series, cached["phy"]
+        print(f"Using cached parse: {cache_path}")
+        return result
+    except Exception:
+        # missing or unreadable cache entry: parse and (re)write it
+        pass
+    result = parse_spn(path, symbol)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            # named tuples are written as plain JSON arrays
+            json.dump({"series": result[0], "phy": result[1]}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # caching is best effort
+        print(f"Warning: could not write parse cache: {e}")
+    return result
+
+def worst_ra_value(raw_a_vals):
+    """Return the most negative (signed) risk-array value, or None if nothing parses."""
+    try:
+        # fast path: reduce straight off the texts, no intermediate float list
+        return min(map(float, raw_a_vals))
+    except ValueError:
+        # thousand separators, stray characters, empty <a/> or an empty array
+        a_vals = parse_ra_values(raw_a_vals)
+        return min(a_vals) if a_vals else None
+
 # ========== Main parsing ==========
-xml_text = read_spn_from_path(INPUT_PATH)
-root = ET.fromstring(xml_text)
-
-# locate pointInTime -> clearingOrg
-point = root.find("pointInTime")
-if point is None:
-    raise ValueError("pointInTime node not found in SPN XML")
-clearing = point.find("clearingOrg")
-if clearing is None:
-    raise ValueError("clearingOrg node not found in SPN XML")
-
-# find all pfCode nodes equal to SYMBOL and collect their parents
-bank_pf_parents = []
-for pf in clearing.findall(".//pfCode"):
-    if (pf.text or "").strip().upper() == SYMBOL:
-        parent = get_parent(clearing, pf)
-        if parent is not None:
-            bank_pf_parents.append(parent)
-
-# find oopPf (options portfolio) and phyPf (underlying) among parents
-oop_pf = next((n for n in bank_pf_parents if n.tag.lower() == "ooppf" or n.tag.lower()=="oopPf".lower()), None)
-phy_pf = next((n for n in bank_pf_parents if n.tag.lower() == "phyPf".lower()), None)
-
-# fallback: try searching by tag directly too
-if oop_pf is None:
-    oop_pf = clearing.find(".//oopPf")
-if phy_pf is None:
-    phy_pf = clearing.find(".//phyPf")
-
-if oop_pf is None or phy_pf is None:
-    # sometimes tags vary; try scanning for pf blocks with pfCode text = SYMBOL
-    # build mapping parent->pfCode
-    found_op = None
-    for p in clearing:
-        pfcode = p.findtext("pfCode") or ""
-        if pfcode.strip().upper() == SYMBOL:
-            # guess which is options (series inside) vs phy
-            if p.find("series") is not None and found_op is None:
-                oop_pf = p
-            elif p.find("phy") is not None:
-                phy_pf = p
-
-if oop_pf is None:
+series_list, phy = parse_spn_cached(INPUT_PATH, SYMBOL)
+
+if series_list is None:
     raise ValueError(f"{SYMBOL} options (oopPf) block not found in SPN")
-if phy_pf is None:
+if phy is None:
     # not fatal: we can still parse options; spot/notional will be None
     print("Warning: underlying phyPf not found; spot/notional columns will be empty.")
 
 # UNDERLYING SPOT and LOT parse
 spot = None
 lot_size = None
-phy_node = phy_pf.find("phy") if phy_pf is not None else None
-if phy_node is not None:
+if phy:
     # common tags that might contain lot or multiplier
-    spot = safe_float(phy_node.findtext("p") or "")
-    # try common lot tags
-    lot_candidates = [phy_node.findtext(t) for t in ("m","mult","mktLot","lotSize","lot","sc","l") if phy_node.findtext(t) is not None]
-    # filter valid floats/ints
-    for cand in lot_candidates:
+    spot = safe_float(phy.get("p") or "")
+    # one lookup per lot tag; the first valid positive value wins
+    for t in LOT_TAGS:
+        cand = phy.get(t)
         if cand:
             try:
                 val = int(float(cand))
-                if val > 0:
-                    lot_size = 35 #val
-                    break
-            except:
-                pass
+            except (ValueError, OverflowError):
+                continue
+            if val > 0:
+                lot_size = val
+                break
 
 # fallback lot if not found
 if lot_size is None:
     lot_size = FALLBACK_LOT
 
-# Collect all series (expiries) under oop_pf
-series_nodes = oop_pf.findall("series")
-if not series_nodes:
+# Collect all series (expiries) under the options block
+if not series_list:
     raise ValueError("No <series> nodes found under BANKNIFTY oopPf")
 
-# Build records
-records = []
-for s in series_nodes:
-    expiry_raw = (s.findtext("pe") or "").strip()
+# Build columns: one list per field, filled while walking the options; the
+# numeric ones are kept as text here and converted column-wise afterwards
+expiry_raw_col, expiry_col, strike_col, type_col = [], [], [], []
+premium_col, delta_col, worst_col = [], [], []
+for expiry_raw, opts in series_list:
+    expiry_raw = (expiry_raw or "").strip()
     # normalize expiry to YYYY-MM-DD if it's YYYYMMDD or 20250828 etc.
     expiry = expiry_raw
     if expiry_raw.isdigit() and len(expiry_raw) == 8:
         expiry = f"{expiry_raw[0:4]}-{expiry_raw[4:6]}-{expiry_raw[6:8]}"
-    # iterate opt nodes
-    for opt in s.findall("opt"):
+    # iterate options; each carries the raw <a> texts of its risk array
+    for typ, strike_txt, premium_txt, delta_txt, raw_a_vals in opts:
         try:
-            typ = (opt.findtext("o") or "").strip()   # C or P
-            strike_txt = (opt.findtext("k") or "").strip()
-            strike = safe_float(strike_txt)
-            premium = safe_float(opt.findtext("p") or "")
-            delta = safe_float(opt.findtext("d") or "")
-            # risk array RA -> list of <a> inside <ra>
-            ra_node = opt.find("ra")
-            if ra_node is None:
-                # skip if no RA present
+            typ = (typ or "").strip()   # C or P
+            worst = worst_ra_value(raw_a_vals)
+            if worst is None:
                 continue
-            raw_a_vals = [a.text for a in ra_node.findall("a")]
-            a_vals = []
-            for v in raw_a_vals:
-                if v is None:
-                    continue
-                vclean = v.strip().replace(",", "")  # remove thousand separators if any
-                try:
-                    a_vals.append(float(vclean))
-                except:
-                    # try to strip non-numeric
-                    filtered = "".join(ch for ch in vclean if ch in "0123456789-+.eE")
-                    try:
-                        a_vals.append(float(filtered))
-                    except:
-                        pass
-            if not a_vals:
-                continue
-            worst = min(a_vals)          # most negative -> worst loss per unit (signed)
-            worst_per_unit = abs(worst)  # positive rupee/point per unit
-            span_per_lot = worst_per_unit * lot_size
-            notional = (spot * lot_size) if spot is not None else None
-
-            # exposures for each rate
-            exposures = {}
-            totals = {}
-            for r in EXPOSURE_RATES:
-                exp_amt = (notional * r) if notional is not None else None
-                tot = span_per_lot + exp_amt if exp_amt is not None else None
-                exposures[f"exposure_{int(r*10000)/100:.4f}_pct"] = exp_amt
-                totals[f"total_{int(r*10000)/100:.4f}_pct"] = tot
-
-            rec = {
-                "expiry_raw": expiry_raw,
-                "expiry": expiry,
-                "strike": strike,
-                "type": typ,
-                "premium_in_rpf": premium,
-                "delta_in_rpf": delta,
-                "worst_RA_per_unit": worst_per_unit,
-                "span_per_lot": span_per_lot,
-                "spot_from_rpf": spot,
-                "lot_size": lot_size,
-                "notional": notional
-            }
-            rec.update(exposures)
-            rec.update(totals)
-            records.append(rec)
         except Exception as e:
             # keep parsing robust; skip problematic option but report
             print(f"Warning: failed to parse an option node: {e}")
             continue
+        expiry_raw_col.append(expiry_raw)
+        expiry_col.append(expiry)
+        strike_col.append(strike_txt or "")
+        type_col.append(typ)
+        premium_col.append(premium_txt or "")
+        delta_col.append(delta_txt or "")
+        # the risk array is reduced as it is parsed instead of being kept around
+        # for a second pass: most negative RA value -> worst loss per unit, as a
+        # positive rupee/point amount
+        worst_col.append(abs(worst))
+
+strike_col = float_column(strike_col)
+premium_col = float_column(premium_col)
+delta_col = float_column(delta_col)
+
+# Margin math, a whole column at a time
+n = len(worst_col)
+span_col = [w * lot_size for w in worst_col]
+# spot and lot size are per file, so notional and exposures are the same for every option
+notional = (spot * lot_size) if spot is not None else None
 
-# Write CSV
 fieldnames = [
     "expiry_raw", "expiry", "strike", "type", "premium_in_rpf", "delta_in_rpf",
     "worst_RA_per_unit", "span_per_lot", "spot_from_rpf", "lot_size", "notional"
 ]
-# extend with exposures/totals based on EXPOSURE_RATES (consistent order)
-for r in EXPOSURE_RATES:
-    tag_exp = f"exposure_{int(r*10000)/100:.4f}_pct"
-    tag_tot = f"total_{int(r*10000)/100:.4f}_pct"
-    fieldnames.append(tag_exp)
-    fieldnames.append(tag_tot)
+columns = [
+    expiry_raw_col, expiry_col, strike_col, type_col, premium_col, delta_col,
+    worst_col, span_col, [spot] * n, [lot_size] * n, [notional] * n
+]
+# extend with exposures/totals based on EXPOSURE_RATES (consistent order);
+# each rate's percentage label is formatted once and shared by both names
+rate_labels = [f"{int(r*10000)/100:.4f}" for r in EXPOSURE_RATES]
+for r, label in zip(EXPOSURE_RATES, rate_labels):
+    exp_amt = (notional * r) if notional is not None else None
+    fieldnames.append(f"exposure_{label}_pct")
+    fieldnames.append(f"total_{label}_pct")
+    columns.append([exp_amt] * n)
+    columns.append([span + exp_amt for span in span_col] if exp_amt is not None else [None] * n)
 
+# Write CSV: rows are zipped straight out of the columns, and csv.writer
+# iterates and formats them in C (no per-row dict or DictWriter lookups)
 with open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as csvf:
-    writer = csv.DictWriter(csvf, fieldnames=fieldnames)
-    writer.writeheader()
-    for rec in records:
-        writer.writerow(rec)
+    writer = csv.writer(csvf)
+    writer.writerow(fieldnames)
+    writer.writerows(zip(*columns))
 
-print(f"✅ Wrote {len(records)} option rows to {OUTPUT_CSV}")
+print(f"✅ Wrote {n} option rows to {OUTPUT_CSV}")
 print(f"Underlying spot (from file): {spot}; lot_size used: {lot_size}")
 print("Example rows (first 6):")
 import itertools, pprint
-pprint.pprint(records[:6])
+pprint.pprint([dict(zip(fieldnames, row)) for row in itertools.islice(zip(*columns), 6)])